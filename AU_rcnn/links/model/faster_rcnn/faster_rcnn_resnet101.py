@@ -4,8 +4,9 @@ import numpy as np
 import chainer
 import chainer.functions as F
 import chainer.links as L
-from chainer.links import ResNet101Layers
-import functools
+from chainer import cuda
+from chainer import function_node
+from chainer.utils import type_check
 from AU_rcnn.links.model.faster_rcnn.faster_rcnn import FasterRCNN
 import config
 from chainer import initializers
@@ -65,6 +66,12 @@ class FasterRCNNResnet101(FasterRCNN):
         score_initialW (callable): Initializer for the score head.
         proposal_creator_params (dict): Key valued paramters for
             :obj:`AU_rcnn.links.model.faster_rcnn.ProposalCreator`.
+        fold_bn (bool): Fold the BN of conv1 and res2 into their convolutions
+            when loading the ImageNet :obj:`resnet101` weights. Only valid
+            with :obj:`fix`. The folded stem always uses the running statistics
+            of the pretrained BN, also in train mode, and its parameter layout
+            differs (conv biases, no BN links), so snapshots of it only load
+            into a model built with :obj:`fold_bn` too.
 
     """
 
@@ -93,7 +100,9 @@ class FasterRCNNResnet101(FasterRCNN):
                  score_initialW=None,
                  mean_file=None,
                  extract_len=None,
-                 fix=False
+                 fix=False,
+                 static_graph=False,
+                 fold_bn=False
                  ):
         if n_fg_class is None:
             if pretrained_model not in self._models:
@@ -106,7 +115,9 @@ class FasterRCNNResnet101(FasterRCNN):
         if fc_initialW is None and pretrained_model:
             fc_initialW = chainer.initializers.constant.Zero()
 
-        extractor = ResnetFeatureExtractor(fix=fix)
+        if fold_bn and not (fix and pretrained_model == 'resnet101'):
+            raise ValueError("fold_bn needs fix=True and the ImageNet 'resnet101' pretrained_model")
+        extractor = ResnetFeatureExtractor(fix=fix, static_graph=static_graph, fold_bn=fold_bn)
         self.extract_len = extract_len
         head = ResRoIHead(
             n_fg_class,  # 注意:全0表示背景。010101才表示多label，因此无需一个特别的0的神经元节点
@@ -135,39 +146,120 @@ class FasterRCNNResnet101(FasterRCNN):
             chainer.serializers.load_npz(pretrained_model, self)
 
     def _copy_imagenet_pretrained_resnet101(self, path):
-        pretrained_model = ResNet101Layers(pretrained_model=path)
-        self.extractor.conv1.copyparams(pretrained_model.conv1)
-        self.extractor.bn1.copyparams(pretrained_model.bn1)
-        self.extractor.res2.copyparams(pretrained_model.res2)
-        self.extractor.res3.copyparams(pretrained_model.res3)
-        self.extractor.res4.copyparams(pretrained_model.res4)
-        self.head.res5.copyparams(pretrained_model.res5)
-        if self.extract_len is not None and self.extract_len == 1000:
-            self.head.fc.copyparams(pretrained_model.fc6)
+        # read the ResNet101Layers npz directly instead of building a whole ResNet101Layers just to copy from it,
+        # NpzFile loads each array lazily on access
+        with np.load(path) as npz:
+            if self.extractor.fold_bn:
+                # conv1, bn1 and res2 are frozen, fold each BN into its conv once here
+                _fold_bn_into_conv(self.extractor.conv1, npz, "conv1", "bn1")
+                _fold_bn_into_block(self.extractor.res2, npz, "res2")
+            else:
+                _load_npz_into(npz, "conv1", self.extractor.conv1)
+                _load_npz_into(npz, "bn1", self.extractor.bn1)
+                _load_npz_into(npz, "res2", self.extractor.res2)
+            _load_npz_into(npz, "res3", self.extractor.res3)
+            _load_npz_into(npz, "res4", self.extractor.res4)
+            _load_npz_into(npz, "res5", self.head.res5)
+            if self.extract_len is not None and self.extract_len == 1000:
+                _load_npz_into(npz, "fc6", self.head.fc)
+
+
+
+class AddReLU(function_node.FunctionNode):
+    """Residual add followed by ReLU, computed in one elementwise pass."""
+
+    def check_type_forward(self, in_types):
+        type_check.expect(in_types.size() == 2)
+        x1_type, x2_type = in_types
+        type_check.expect(
+            x1_type.dtype.kind == 'f',
+            x1_type.dtype == x2_type.dtype,
+            x1_type.shape == x2_type.shape,
+        )
+
+    def forward_cpu(self, inputs):
+        x1, x2 = inputs
+        y = x1 + x2
+        np.maximum(y, 0, out=y)
+        self.retain_outputs((0,))
+        return y,
+
+    def forward_gpu(self, inputs):
+        x1, x2 = inputs
+        y = cuda.elementwise(
+            'T x1, T x2', 'T y',
+            'y = max(x1 + x2, (T)0)',
+            'add_relu_fwd')(x1, x2)
+        self.retain_outputs((0,))
+        return y,
+
+    def backward(self, indexes, grad_outputs):
+        y, = self.get_retained_outputs()
+        gy, = grad_outputs
+        gx = gy * (y.array > 0).astype(gy.dtype)
+        return gx, gx
+
+
+def add_relu(x1, x2):
+    """Equivalent to ``F.relu(x1 + x2)`` without the intermediate sum."""
+    return AddReLU().apply((x1, x2))[0]
+
+
+def _identity(x):
+    return x
+
+
+def _batch_normalization(size, fold_bn):
+    # a folded BN lives in the bias of the preceding conv, see _fold_bn_into_conv
+    if fold_bn:
+        return _identity
+    return L.BatchNormalization(size)
+
+
+def _load_npz_into(npz, prefix, link):
+    chainer.serializers.NpzDeserializer(npz, path=prefix + "/").load(link)
+
 
+def _fold_bn_into_conv(conv, npz, conv_key, bn_key, eps=2e-5):
+    # eps is the default of the BatchNormalization links in ResNet101Layers
+    # W' = W * gamma / sqrt(var + eps),  b' = beta + (b - mean) * gamma / sqrt(var + eps)
+    scale = npz[bn_key + "/gamma"] / np.sqrt(npz[bn_key + "/avg_var"] + eps)
+    conv.W.data[...] = npz[conv_key + "/W"] * scale[:, None, None, None]
+    b = npz[conv_key + "/b"] if conv_key + "/b" in npz else 0
+    conv.b.data[...] = npz[bn_key + "/beta"] + (b - npz[bn_key + "/avg_mean"]) * scale
+
+
+def _fold_bn_into_block(block, npz, prefix):
+    for name in block.names:
+        bottleneck = getattr(block, name)
+        for i in range(1, 5):  # only BottleNeckA has conv4
+            conv_name = "conv{}".format(i)
+            if hasattr(bottleneck, conv_name):
+                _fold_bn_into_conv(getattr(bottleneck, conv_name), npz,
+                                   "{0}/{1}/conv{2}".format(prefix, name, i), "{0}/{1}/bn{2}".format(prefix, name, i))
 
 
 class BottleNeckA(chainer.Chain):
 
-    def __init__(self, in_size, ch, out_size, stride=2):
+    def __init__(self, in_size, ch, out_size, stride=2, fold_bn=False):
         super(BottleNeckA, self).__init__()
         initialW = initializers.HeNormal()
 
         with self.init_scope():
             self.conv1 = L.Convolution2D(
-                in_size, ch, 1, stride, 0, initialW=initialW, nobias=True)
-            self.bn1 = L.BatchNormalization(ch)
+                in_size, ch, 1, stride, 0, initialW=initialW, nobias=not fold_bn)
+            self.bn1 = _batch_normalization(ch, fold_bn)
             self.conv2 = L.Convolution2D(
-                ch, ch, 3, 1, 1, initialW=initialW, nobias=True)
-            self.bn2 = L.BatchNormalization(ch)
+                ch, ch, 3, 1, 1, initialW=initialW, nobias=not fold_bn)
+            self.bn2 = _batch_normalization(ch, fold_bn)
             self.conv3 = L.Convolution2D(
-                ch, out_size, 1, 1, 0, initialW=initialW, nobias=True)
-            self.bn3 = L.BatchNormalization(out_size)
+                ch, out_size, 1, 1, 0, initialW=initialW, nobias=not fold_bn)
+            self.bn3 = _batch_normalization(out_size, fold_bn)
 
             self.conv4 = L.Convolution2D(
                 in_size, out_size, 1, stride, 0,
-                initialW=initialW, nobias=True)
-            self.bn4 = L.BatchNormalization(out_size)
+                initialW=initialW, nobias=not fold_bn)
+            self.bn4 = _batch_normalization(out_size, fold_bn)
 
     def __call__(self, x):
         h1 = F.relu(self.bn1(self.conv1(x)))
@@ -175,46 +267,48 @@ class BottleNeckA(chainer.Chain):
         h1 = self.bn3(self.conv3(h1))
         h2 = self.bn4(self.conv4(x))
 
-        return F.relu(h1 + h2)
+        return add_relu(h1, h2)
 
 class BottleNeckB(chainer.Chain):
 
-    def __init__(self, in_size, ch):
+    def __init__(self, in_size, ch, fold_bn=False):
         super(BottleNeckB, self).__init__()
         initialW = initializers.HeNormal()
 
         with self.init_scope():
             self.conv1 = L.Convolution2D(
-                in_size, ch, 1, 1, 0, initialW=initialW, nobias=True)
-            self.bn1 = L.BatchNormalization(ch)
+                in_size, ch, 1, 1, 0, initialW=initialW, nobias=not fold_bn)
+            self.bn1 = _batch_normalization(ch, fold_bn)
             self.conv2 = L.Convolution2D(
-                ch, ch, 3, 1, 1, initialW=initialW, nobias=True)
-            self.bn2 = L.BatchNormalization(ch)
+                ch, ch, 3, 1, 1, initialW=initialW, nobias=not fold_bn)
+            self.bn2 = _batch_normalization(ch, fold_bn)
             self.conv3 = L.Convolution2D(
-                ch, in_size, 1, 1, 0, initialW=initialW, nobias=True)
-            self.bn3 = L.BatchNormalization(in_size)
+                ch, in_size, 1, 1, 0, initialW=initialW, nobias=not fold_bn)
+            self.bn3 = _batch_normalization(in_size, fold_bn)
 
     def __call__(self, x):
         h = F.relu(self.bn1(self.conv1(x)))
         h = F.relu(self.bn2(self.conv2(h)))
         h = self.bn3(self.conv3(h))
 
-        return F.relu(h + x)
+        return add_relu(h, x)
 
 class Block(chainer.Chain):
 
-    def __init__(self, layer, in_size, ch, out_size, stride=2):
+    def __init__(self, layer, in_size, ch, out_size, stride=2, fold_bn=False):
         super(Block, self).__init__()
-        self.add_link('a', BottleNeckA(in_size, ch, out_size, stride))
+        self.add_link('a', BottleNeckA(in_size, ch, out_size, stride, fold_bn=fold_bn))
         for i in range(1, layer):
-            self.add_link('b{}'.format(i), BottleNeckB(out_size, ch))
+            self.add_link('b{}'.format(i), BottleNeckB(out_size, ch, fold_bn=fold_bn))
         self.layer = layer
+        # child names in forward order, built once. names rather than the links themselves,
+        # because Link.copy() replaces the children and a cached list would still point to the old ones
+        self.names = tuple(['a'] + ['b{}'.format(i) for i in range(1, layer)])
 
     def __call__(self, x):
-        h = self.a(x)
-        for i in range(1, self.layer):
-            h = self['b{}'.format(i)](h)
-
+        h = x
+        for name in self.names:
+            h = getattr(self, name)(h)
         return h
 
 
@@ -248,7 +342,7 @@ class ResRoIHead(chainer.Chain):
             self.score = L.Linear(extract_len, n_class, initialW=score_initialW)
         self.functions = collections.OrderedDict([
             ('res5',  [self.res5]),
-            ("avg_pool", [functools.partial(F.average_pooling_2d, ksize=7, stride=1)]),  # because res5 will decrease height and width by factor of 2
+            ("avg_pool", [_global_average_pooling_2d]),  # because res5 will decrease height and width by factor of 2
             ("fc",    [self.fc]),
             ('relu',  [F.relu]),
             ("score", [self.score]),
@@ -277,10 +371,8 @@ class ResRoIHead(chainer.Chain):
 
         """
         target_layers = set(layers)
-        roi_indices = roi_indices.astype(np.float32)
-        indices_and_rois = self.xp.concatenate(
-            (roi_indices[:, None], rois), axis=1)  # None means np.newaxis, concat along column
-        pool = _roi_pooling_2d_yx(
+        indices_and_rois = _xy_indices_and_rois(rois, roi_indices, x.dtype)
+        pool = F.roi_pooling_2d(
             x, indices_and_rois, self.roi_size, self.roi_size,
             self.spatial_scale)
         h = pool
@@ -293,6 +385,28 @@ class ResRoIHead(chainer.Chain):
         return h
 
 
+def _xy_indices_and_rois(rois, roi_indices, dtype):
+    """Build the :math:`(R', 5)` input of :func:`chainer.functions.roi_pooling_2d`.
+
+    The columns are written straight into one array of :obj:`dtype`, so no
+    casted copy of :obj:`roi_indices` and no concatenated yx array is made.
+
+    Args:
+        rois (array): RoIs in :math:`(y_{min}, x_{min}, y_{max}, x_{max})` order, shape :math:`(R', 4)`.
+        roi_indices (array): Image index of each RoI, shape :math:`(R',)`.
+        dtype: dtype of the feature map the RoIs are pooled from.
+
+    """
+    xp = cuda.get_array_module(rois)
+    indices_and_rois = xp.empty((rois.shape[0], 5), dtype=dtype)
+    indices_and_rois[:, 0] = roi_indices
+    indices_and_rois[:, 1] = rois[:, 1]
+    indices_and_rois[:, 2] = rois[:, 0]
+    indices_and_rois[:, 3] = rois[:, 3]
+    indices_and_rois[:, 4] = rois[:, 2]
+    return indices_and_rois
+
+
 class ResnetFeatureExtractor(chainer.Chain):
 
     """Truncated VGG-16 that extracts a conv5_3 feature map.
@@ -302,38 +416,53 @@ class ResnetFeatureExtractor(chainer.Chain):
 
     """
 
-    def __init__(self, fix):
+    def __init__(self, fix, static_graph=False, fold_bn=False):
         super(ResnetFeatureExtractor, self).__init__()
         with self.init_scope():
-            self.conv1 = L.Convolution2D(3, 64, 7, 2, 3, initialW=initializers.HeNormal(), nobias=True)
-            self.bn1 = L.BatchNormalization(64)
-            self.res2 = Block(3, 64, 64, 256, 1)
+            # when fold_bn is set, the BN of conv1 and res2 are folded into conv weights at load time
+            self.conv1 = L.Convolution2D(3, 64, 7, 2, 3, initialW=initializers.HeNormal(), nobias=not fold_bn)
+            self.bn1 = _batch_normalization(64, fold_bn)
+            self.res2 = Block(3, 64, 64, 256, 1, fold_bn=fold_bn)
             self.res3 = Block(4, 256, 128, 512)
             self.res4 = Block(23, 512, 256, 1024)
         self.fix = fix
+        self.fold_bn = fold_bn
+        if fold_bn:
+            # the folded stem never gets a gradient, so no optimizer state is needed for it
+            self.conv1.disable_update()
+            self.res2.disable_update()
+        # the fix branch is chosen once here so that res3 and res4 form a branch free subgraph,
+        # plain functions (not bound methods) are stored so that Link.copy() stays correct
+        self._stem = ResnetFeatureExtractor._fixed_stem if fix else ResnetFeatureExtractor._trainable_stem
+        self._trunk = ResnetFeatureExtractor._trunk_forward
+        if static_graph:
+            self._trunk = chainer.static_graph(ResnetFeatureExtractor._trunk_forward)
 
     def __call__(self, x):
+        if x.dtype != self.conv1.W.dtype:  # images are prepared as float32, parameters may be float16
+            x = F.cast(x, self.conv1.W.dtype)
+        h = self._stem(self, x)
+        return self._trunk(self, h)
 
-        if self.fix:
-            with chainer.no_backprop_mode():
-                h = self.bn1(self.conv1(x))
-                h = F.max_pooling_2d(F.relu(h), 3, stride=2)
-                h = self.res2(h)
-        else:
-            h = self.bn1(self.conv1(x))
-            h = F.max_pooling_2d(F.relu(h), 3, stride=2)
-            h = self.res2(h)
+    def _trainable_stem(self, x):
+        h = self.bn1(self.conv1(x))
+        h = F.max_pooling_2d(F.relu(h), 3, stride=2)
+        return self.res2(h)
+
+    def _fixed_stem(self, x):
+        with chainer.no_backprop_mode():
+            return self._trainable_stem(x)
+
+    def _trunk_forward(self, h):
         h = self.res3(h)
         h = self.res4(h)
         return h
 
 
-def _roi_pooling_2d_yx(x, indices_and_rois, outh, outw, spatial_scale):
-
-    xy_indices_and_rois = indices_and_rois[:, [0, 2, 1, 4, 3]]
-    pool = F.roi_pooling_2d(
-        x, xy_indices_and_rois, outh, outw, spatial_scale)
-    return pool
+def _global_average_pooling_2d(x):
+    # res5 output of each RoI is 7 x 7, a single mean reduction replaces the 7 x 7 average pooling window
+    # and gives the (R', 2048) feature directly
+    return F.mean(x, axis=(2, 3))
 
 
 def _max_pooling_2d(x):
@@ -1,10 +1,7 @@
 import chainer
 import chainer.functions as F
-import numpy as np
 from chainer import cuda
 
-import config
-
 
 class FasterRCNNTrainChain(chainer.Chain):
 
@@ -33,6 +30,7 @@ class FasterRCNNTrainChain(chainer.Chain):
     def __init__(self, faster_rcnn):
         super(FasterRCNNTrainChain, self).__init__()
         self.neg_pos_ratio = 3
+        self._zero_idx_cache = None  # reused as roi indices when batch size is 1
         with self.init_scope():
             self.faster_rcnn = faster_rcnn
 
@@ -48,10 +46,10 @@ class FasterRCNNTrainChain(chainer.Chain):
 
         Args:
             imgs (~chainer.Variable): A variable with a batch of images. shape is (N C H W)
-            bboxes (~chainer.Variable): A batch of ground truth bounding boxes.
+            bboxes (array): A batch of ground truth bounding boxes.
                 Its shape is :math:`(N, R, 4)`.
 
-            labels (~chainer.Variable): A batch of labels.
+            labels (array): A batch of labels.
                 Its shape is :math:`(N, R, L)`. this is for the multi-label region,
                  The background is excluded from the definition, which means that the range of the value
                 is :math:`[-1,0,1]`.0 means this AU index does not occur. -1 means ignore_label
@@ -66,10 +64,8 @@ class FasterRCNNTrainChain(chainer.Chain):
         """
         xp = cuda.get_array_module(imgs)
         with cuda.get_device_from_array(imgs) as device:
-            if isinstance(bboxes, chainer.Variable):
-                bboxes = bboxes.data
-            if isinstance(labels, chainer.Variable):
-                labels = labels.data
+            # the updater's converter passes plain arrays, not Variables
+            assert not isinstance(bboxes, chainer.Variable) and not isinstance(labels, chainer.Variable)
 
             batch_size = bboxes.shape[0]
 
@@ -78,81 +74,75 @@ class FasterRCNNTrainChain(chainer.Chain):
             features = self.faster_rcnn.extractor(imgs)
             # Since batch size is one, convert variables to singular form
             if batch_size > 1:
-                sample_roi_lst = []
-                sample_roi_index_lst = []
-                gt_roi_label = []
-                for n in range(batch_size):
-                    bbox = bboxes[n]  # bbox仍然是一个list，表示一个图内部的bbox
-                    label = labels[n]  # label仍然是一个list，表示一个图内部的label
-                    # 若其中的一个label为-99 表示是padding的值，此时该bbox是[-99,-99,-99,-99]
-                    bbox = bbox[bbox != xp.array(-99)].reshape(-1, 4)
-                    label = label[label != xp.array(-99)].reshape(-1, len(config.AU_SQUEEZE))
-                    assert label.shape[0] == bbox.shape[0] and bbox.shape[0] > 0
-                    # Sample RoIs and forward
-                    sample_roi = bbox
-                    sample_roi_index = n * np.ones((len(sample_roi),), dtype=xp.int32)
-                    gt_roi_label.extend(label)  # list 可以extend ndarray
-                    sample_roi_lst.extend(sample_roi)
-                    sample_roi_index_lst.extend(sample_roi_index)
-                sample_roi_lst = xp.stack(sample_roi_lst).astype(dtype=xp.float32)
-                gt_roi_label = xp.stack(gt_roi_label).astype(dtype=xp.int32)
-                sample_roi_index_lst = xp.asarray(sample_roi_index_lst).astype(dtype=xp.int32)
+                # 若其中的一个label为-99 表示是padding的值，此时该bbox是[-99,-99,-99,-99]
+                valid = (bboxes != -99).all(axis=2)  # shape = (N, R)
+                assert bool(valid.any(axis=1).all())
+                sample_roi_lst = bboxes[valid].astype(dtype=xp.float32)  # shape = (R', 4)
+                gt_roi_label = labels[valid].astype(dtype=xp.int32)  # shape = (R', L)
+                sample_roi_index_lst = xp.broadcast_to(
+                    xp.arange(batch_size, dtype=xp.int32)[:, None], valid.shape)[valid]
 
             elif batch_size == 1:  # batch_size = 1
                 bbox = bboxes[0]
                 label = labels[0]
                 sample_roi_lst, gt_roi_label = bbox, label
-                sample_roi_index_lst = xp.zeros((len(sample_roi_lst),), dtype=xp.int32)
+                R = sample_roi_lst.shape[0]
+                if self._zero_idx_cache is None or self._zero_idx_cache.size < R:
+                    self._zero_idx_cache = xp.zeros((max(R, 512),), dtype=xp.int32)
+                sample_roi_index_lst = self._zero_idx_cache[:R]
 
             roi_score = self.faster_rcnn.head(
                 features, sample_roi_lst, sample_roi_index_lst)
+            if roi_score.dtype != xp.float32:  # compute the loss in float32 when the model runs in float16
+                roi_score = F.cast(roi_score, xp.float32)
             # Losses for outputs of the head.
             assert roi_score.shape[0] == gt_roi_label.shape[0]
 
-            # 算sigmoid的时候，从gt中挑选=1的元素，然后从pred=1 但gt=0中挑选元素，如果还不够再从剩下的随机挑选凑够x 3倍的=0元素，最后算sigmoid cross entropy
-            union_gt = set()  # union of prediction positive and ground truth positive
-            cpu_gt_roi_label = chainer.cuda.to_cpu(gt_roi_label)
-            gt_pos_index = np.nonzero(cpu_gt_roi_label)
-            cpu_pred_score = (chainer.cuda.to_cpu(roi_score.data) > 0).astype(np.int32)
-            pred_pos_index = np.nonzero(cpu_pred_score)
-            len_gt_pos = len(gt_pos_index[0]) if len(gt_pos_index[0]) > 0 else 1
-            neg_pick_count = self.neg_pos_ratio * len_gt_pos
-            gt_pos_index_set = set(list(zip(*gt_pos_index)))
-            pred_pos_index_set = set(list(zip(*pred_pos_index)))
-            union_gt.update(gt_pos_index_set)
-            union_gt.update(pred_pos_index_set)
-            false_positive_index = np.asarray(list(pred_pos_index_set - gt_pos_index_set))  # shape = n x 2
-            gt_pos_index_lst = list(gt_pos_index_set)
-            if neg_pick_count <= len(false_positive_index):
-                choice_fp = np.random.choice(np.arange(len(false_positive_index)), size=neg_pick_count, replace=False)
-                gt_pos_index_lst.extend(list(map(tuple,false_positive_index[choice_fp].tolist())))
-            else:
-                gt_pos_index_lst.extend(list(map(tuple, false_positive_index.tolist())))
-                rest_pick_count = neg_pick_count - len(false_positive_index)
-                gt_neg_index = np.where(cpu_gt_roi_label == 0)
-                gt_neg_index_set = set(list(zip(*gt_neg_index)))
-                gt_neg_index_set = gt_neg_index_set - set(gt_pos_index_lst)  # remove already picked
-                gt_neg_index_array = np.asarray(list(gt_neg_index_set))
-                choice_rest = np.random.choice(np.arange(len(gt_neg_index_array)), size=rest_pick_count, replace=False)
-                gt_pos_index_lst.extend(list(map(tuple,gt_neg_index_array[choice_rest].tolist())))
-            # TODO need class imbalance? NO
-
-            pick_index = list(zip(*gt_pos_index_lst))
-            if len(union_gt) == 0:
-                accuracy_pick_index = np.where(cpu_gt_roi_label)
-            else:
-                accuracy_pick_index = list(zip(*union_gt))
-            accuracy = F.binary_accuracy(roi_score[list(accuracy_pick_index[0]), list(accuracy_pick_index[1])],
-                                         gt_roi_label[list(accuracy_pick_index[0]), list(accuracy_pick_index[1])])
-            loss = F.sigmoid_cross_entropy(roi_score[list(pick_index[0]), list(pick_index[1])],
-                                               gt_roi_label[list(pick_index[0]), list(pick_index[1])])  # 支持多label
+            pick_index, accuracy_pick_index = self._sample_indices(gt_roi_label, roi_score.data)
+            roi_score_flat = F.reshape(roi_score, (-1,))
+            gt_roi_label_flat = gt_roi_label.ravel()
+            accuracy = F.binary_accuracy(roi_score_flat[accuracy_pick_index], gt_roi_label_flat[accuracy_pick_index])
+            loss = F.sigmoid_cross_entropy(roi_score_flat[pick_index], gt_roi_label_flat[pick_index])  # 支持多label
 
             chainer.reporter.report({
                                      'loss': loss, "accuracy": accuracy},
                                     self)
         return loss
 
+    def _sample_indices(self, gt_roi_label, roi_score):
+        """Pick the score entries the loss and the accuracy are computed on.
 
+        Args:
+            gt_roi_label (array): Labels of shape :math:`(R', L)`.
+            roi_score (array): Raw scores of shape :math:`(R', L)`.
 
+        Returns:
+            tuple of two arrays:
+            Flat indices into the raveled :math:`(R', L)` matrix, first for the loss
+            and then for the accuracy.
 
-
+        """
+        xp = cuda.get_array_module(gt_roi_label)
+        # 算sigmoid的时候，从gt中挑选=1的元素，然后从pred=1 但gt=0中挑选元素，如果还不够再从剩下的随机挑选凑够x 3倍的=0元素，最后算sigmoid cross entropy
+        # all index arrays below are flat indices into the (R', L) score matrix and stay on the device
+        gt_pos_mask = gt_roi_label != 0
+        pred_pos_mask = roi_score > 0
+        false_positive_mask = pred_pos_mask & ~gt_pos_mask
+        gt_neg_mask = (gt_roi_label == 0) & ~pred_pos_mask  # gt negative that is not already a false positive
+        gt_pos_index = xp.nonzero(gt_pos_mask.ravel())[0]
+        false_positive_index = xp.nonzero(false_positive_mask.ravel())[0]
+        len_gt_pos = len(gt_pos_index) if len(gt_pos_index) > 0 else 1
+        neg_pick_count = self.neg_pos_ratio * len_gt_pos
+        choice_fp = false_positive_index[xp.random.permutation(len(false_positive_index))[:neg_pick_count]]
+        rest_pick_count = neg_pick_count - len(choice_fp)
+        if rest_pick_count > 0:
+            gt_neg_index = xp.nonzero(gt_neg_mask.ravel())[0]
+            choice_rest = gt_neg_index[xp.random.permutation(len(gt_neg_index))[:rest_pick_count]]
+        else:
+            choice_rest = gt_pos_index[:0]
+        # TODO need class imbalance? NO
+
+        pick_index = xp.concatenate((gt_pos_index, choice_fp, choice_rest))
+        # union of prediction positive and ground truth positive
+        accuracy_pick_index = xp.nonzero((gt_pos_mask | pred_pos_mask).ravel())[0]
+        return pick_index, accuracy_pick_index
@@ -154,6 +154,10 @@ def main():
     parser.add_argument('--fake_box', action="store_true", help="whether to use fake average box coordinate to predict")
     parser.add_argument('--roi_align', action="store_true",
                         help="whether to use roi_align or roi_pooling")
+    parser.add_argument('--static_graph', action="store_true",
+                        help="whether to run res3/res4 of resnet101 as a chainer static subgraph")
+    parser.add_argument('--fp16', action="store_true",
+                        help="whether to use float16 parameters and activations (fp32 master weights, loss scale 128)")
     args = parser.parse_args()
     if not os.path.exists(args.pid):
         os.makedirs(args.pid)
@@ -179,6 +183,10 @@ def main():
         if mc_manager is None:
             raise IOError("no memcached found listen in {}".format(args.memcached_host))
 
+    if args.fp16 and (args.FPN or args.feature_model != 'resnet101'):
+        # only ResnetFeatureExtractor casts the float32 images to the dtype of its parameters
+        raise ValueError("--fp16 is only supported with --feature_model resnet101, got {}".format(
+            "FPN" if args.FPN else args.feature_model))
     if args.FPN:
         faster_rcnn = FPN101(len(config.AU_SQUEEZE), pretrained_resnet=args.pretrained_model, use_roialign=args.roi_align,
                              mean_path=args.mean,min_size=args.img_resolution,max_size=args.img_resolution)
@@ -195,10 +203,17 @@ def main():
                                       min_size=args.img_resolution, max_size=args.img_resolution,
                                       extract_len=args.extract_len, dataset=args.database, fold=args.fold, split_idx=args.split_idx)
     elif args.feature_model == 'resnet101':
+        # let cuDNN benchmark and cache the fastest algorithm of each bottleneck convolution
+        chainer.global_config.autotune = True
+        chainer.global_config.use_cudnn = 'always'
+        chainer.global_config.cudnn_deterministic = False
+        chainer.global_config.cudnn_fast_batch_normalization = True
+        if args.fp16:
+            chainer.global_config.dtype = np.dtype(np.float16)  # parameters are created in this dtype
         faster_rcnn = FasterRCNNResnet101(n_fg_class=len(config.AU_SQUEEZE),
                                       pretrained_model=args.pretrained_model,
                                       mean_file=args.mean,  min_size=args.img_resolution,max_size=args.img_resolution,
-                                      extract_len=args.extract_len)  # 可改为/home/nco/face_expr/result/snapshot_model.npz
+                                      extract_len=args.extract_len, static_graph=args.static_graph)  # 可改为/home/nco/face_expr/result/snapshot_model.npz
     elif args.feature_model == "mobilenet_v1":
         faster_rcnn = FasterRCNN_MobilenetV1(pretrained_model_type=args.pretrained_model_args,
                                       min_size=config.IMG_SIZE[0], max_size=config.IMG_SIZE[1],
@@ -317,6 +332,8 @@ def main():
 
 
     optimizer.setup(model)
+    if args.fp16:
+        optimizer.use_fp32_update()  # keep fp32 master copy of fp16 parameters
     optimizer.add_hook(chainer.optimizer.WeightDecay(rate=0.0005))
     optimizer_name = args.optimizer
     lstm_str = "linear"
@@ -348,6 +365,7 @@ def main():
             print("loading pretrained snapshot:{}".format(single_model_file_name))
             chainer.serializers.load_npz(single_model_file_name, model.faster_rcnn)
 
+    loss_scale = 128 if args.fp16 else None
     if "," in args.gpu:
         gpu_dict = {"main": int(args.gpu.split(",")[0])} # many gpu will use
         for slave_gpu in args.gpu.split(",")[1:]:
@@ -355,11 +373,13 @@ def main():
         updater = chainer.training.ParallelUpdater(train_iter, optimizer,
                                                    devices=gpu_dict,
                                                    converter=lambda batch, device: concat_examples(batch, device,
-                                                                                                   padding=-99))
+                                                                                                   padding=-99),
+                                                   loss_scale=loss_scale)
     else:
         print("only one GPU({0}) updater".format(args.gpu))
         updater = chainer.training.StandardUpdater(train_iter, optimizer, device=int(args.gpu),
-                              converter=lambda batch, device: concat_examples(batch, device, padding=-99))
+                              converter=lambda batch, device: concat_examples(batch, device, padding=-99),
+                              loss_scale=loss_scale)
 
     trainer = training.Trainer(
         updater, (args.epoch, 'epoch'), out=args.out)
@@ -0,0 +1,60 @@
+import os
+import pickle
+import threading
+from collections import defaultdict
+
+import lmdb
+
+
+class LMDBCropFaceManager(object):
+    '''
+    On-disk cache of FaceMaskCropper.get_cropface_and_box results,
+    value is the cropped face (uint8, the layout returned by the cropper) and its AU_box_dict.
+    The environment is opened lazily and reopened after fork, so each MultiprocessIterator worker has its own handle.
+    '''
+    def __init__(self, path, readonly=False, map_size=int(1e12)):
+        self.path = path
+        self.readonly = readonly
+        self.map_size = map_size
+        self._env = None
+        self._pid = None
+        self._open_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_env"] = None  # lmdb handle can not be pickled nor shared between process
+        state["_pid"] = None
+        del state["_open_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_lock = threading.Lock()
+
+    @property
+    def env(self):
+        if self._env is None or self._pid != os.getpid():
+            with self._open_lock:  # an environment can only be opened once per process, even with reader threads
+                if self._env is None or self._pid != os.getpid():
+                    if self.readonly:
+                        self._env = lmdb.open(self.path, readonly=True, lock=False, max_readers=128,
+                                              readahead=False)
+                    else:
+                        self._env = lmdb.open(self.path, map_size=self.map_size, max_readers=128, readahead=False)
+                    self._pid = os.getpid()
+        return self._env
+
+    def get(self, key):
+        with self.env.begin(write=False, buffers=True) as txn:
+            buf = txn.get(key.encode())
+            if buf is None:
+                return None
+            new_face, AU_box_dict = pickle.loads(buf)
+        return new_face, defaultdict(list, AU_box_dict)
+
+    def set(self, key, new_face, AU_box_dict):
+        if self.readonly:
+            return
+        value = pickle.dumps((new_face, dict(AU_box_dict)), protocol=pickle.HIGHEST_PROTOCOL)
+        with self.env.begin(write=True) as txn:
+            txn.put(key.encode(), value)
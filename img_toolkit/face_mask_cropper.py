@@ -92,7 +92,8 @@ class FaceMaskCropper(object):
         del orig_img
         AU_box_dict =defaultdict(list)
 
-        for AU in config.AU_ROI.keys():
+        # insert AU in int order, so the consumers can walk AU_box_dict.items() without sorting it per example
+        for AU in sorted(config.AU_ROI.keys(), key=int):
             mask = crop_face_mask_from_landmark(AU, landmark_dict, new_face, rect, landmarker=FaceMaskCropper.landmark)
             connect_arr = cv2.connectedComponents(mask, connectivity=8, ltype=cv2.CV_32S)  # mask shape = 1 x H x W
             component_num = connect_arr[0]
@@ -1,5 +1,7 @@
 import cv2
+import functools
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 import chainer
 import numpy as np
@@ -14,13 +16,22 @@ import glob
 class AUDataset(chainer.dataset.DatasetMixin):
 
     def __init__(self, database, L, fold, split_name, split_index, mc_manager, train_all_data,
-                 pretrained_target="",paper_report_label_idx=None, jump_exists=True, npz_dir=""):
+                 pretrained_target="",paper_report_label_idx=None, jump_exists=True, npz_dir="", lmdb_manager=None,
+                 memmap_dir="", flow_fetch_threads=1):
         self.database = database
         self.split_name = split_name
         self.L = L  # used for the optical flow image fetch at before L/2 and after L/2
         self.au_couple_dict = get_zip_ROI_AU()
         self.mc_manager = mc_manager
+        self.lmdb_manager = lmdb_manager  # local on-disk cache of cropped face and AU box, checked before mc_manager
         self.au_couple_child_dict = get_AU_couple_child(self.au_couple_dict)
+        self.AU_squeeze_idx = {AU: int(AU_squeeze) for AU, AU_squeeze in config.AU_SQUEEZE.inv.items()}  # AU -> int
+        # opencv decode and lmdb read release the GIL, so the L flow crops of one example can be fetched by threads.
+        # pylibmc Client is not thread safe, so threads are only allowed without mc_manager
+        assert flow_fetch_threads == 1 or mc_manager is None, "flow_fetch_threads > 1 can not share mc_manager"
+        self.flow_fetch_threads = min(flow_fetch_threads, L)
+        self._flow_pool = None
+        self._flow_pool_pid = None
         self.AU_intensity_label = {}  # subject + "/" + emotion_seq + "/" + frame => ... not implemented
         self.pretrained_target = pretrained_target
         self.dir = config.DATA_PATH[database] # BP4D/DISFA/ BP4D_DISFA
@@ -37,36 +48,88 @@ class AUDataset(chainer.dataset.DatasetMixin):
         self.jump_exists = jump_exists
         self.npz_dir = npz_dir
 
+        self.id_list_name = os.path.splitext(os.path.basename(id_list_file_path))[0]
+
         print("idfile:{}".format(id_list_file_path))
+        valid_AU = set(AU for AU in config.AU_ROI if AU in config.AU_SQUEEZE.inv)
+        dir_files = dict()  # one listdir per frame folder instead of one os.path.exists per line
         with open(id_list_file_path, "r") as file_obj:
-            for idx, line in enumerate(file_obj):
-                if line.rstrip():
-                    line = line.rstrip()
-                    relative_path, au_set_str, _, current_database_name = line.split("\t")
-                    AU_set = set(AU for AU in au_set_str.split(',') if AU in config.AU_ROI and AU in config.AU_SQUEEZE.inv)
-                    if au_set_str == "0":
-                        AU_set = set()
-                    rgb_path = config.RGB_PATH[current_database_name] + os.path.sep + relative_path  # id file 是相对路径
-                    flow_path = config.FLOW_PATH[current_database_name] + os.path.sep + relative_path
-                    if os.path.exists(rgb_path):
-                        self.result_data.append((rgb_path, flow_path, AU_set, current_database_name))
-
-        self.result_data.sort(key=lambda entry: (entry[0].split("/")[-3],entry[0].split("/")[-2],
-                                                 int(entry[0].split("/")[-1][:entry[0].split("/")[-1].rindex(".")])))
+            id_lines = file_obj.read().splitlines()
+        for line in id_lines:
+            line = line.rstrip()
+            if line:
+                relative_path, au_set_str, _, current_database_name = line.split("\t", 3)
+                AU_set = set()
+                if au_set_str != "0":
+                    AU_set = set(AU for AU in au_set_str.split(',') if AU in valid_AU)
+                rgb_path = config.RGB_PATH[current_database_name] + os.path.sep + relative_path  # id file 是相对路径
+                flow_path = config.FLOW_PATH[current_database_name] + os.path.sep + relative_path
+                rgb_dir, rgb_file_name = os.path.split(rgb_path)
+                if rgb_dir not in dir_files:
+                    dir_files[rgb_dir] = set(os.listdir(rgb_dir)) if os.path.isdir(rgb_dir) else set()
+                if rgb_file_name in dir_files[rgb_dir]:
+                    self.result_data.append((rgb_path, flow_path, AU_set, current_database_name))
+
+        def frame_order(entry):  # subject, sequence, frame number; one rsplit instead of five split per entry
+            subject, sequence, frame = entry[0].rsplit("/", 3)[-3:]
+            return subject, sequence, int(frame[:frame.rindex(".")])
+        self.result_data.sort(key=frame_order)
         self._num_examples = len(self.result_data)
+        # integer id of the sequence each example belongs to, so neighbour frames are matched without string split
+        seq_key_id = dict()
+        self.seq_ids = np.array([seq_key_id.setdefault(self.extract_sequence_key(entry[0]), len(seq_key_id))
+                                 for entry in self.result_data], dtype=np.int32)
         print("read id file done, all examples:{}".format(self._num_examples))
+        # resized uncropped images of the whole split, built once by time_axis_rcnn/script/build_face_memmap.py,
+        # used when no face box can be found instead of decoding and resizing the jpg again
+        self.rgb_memmap = None
+        self.flow_memmap = None
+        if memmap_dir:
+            # rows are matched to result_data by position only, refuse a memmap built from another image list
+            with open(self.memmap_path(memmap_dir, "paths", "txt"), "r") as file_obj:
+                memmap_rgb_paths = file_obj.read().splitlines()
+            if memmap_rgb_paths != [entry[0] for entry in self.result_data]:
+                raise ValueError("memmap in {0} was built from {1} images, which do not match the {2} images of "
+                                 "this split, rebuild it by time_axis_rcnn/script/build_face_memmap.py".format(
+                                     memmap_dir, len(memmap_rgb_paths), self._num_examples))
+            self.rgb_memmap = np.memmap(self.memmap_path(memmap_dir, "rgb"), dtype=np.uint8, mode='r',
+                                        shape=(self._num_examples, 3, config.IMG_SIZE[1], config.IMG_SIZE[0]))
+            self.flow_memmap = np.memmap(self.memmap_path(memmap_dir, "flow"), dtype=np.uint8, mode='r',
+                                         shape=(self._num_examples, 2, config.IMG_SIZE[1], config.IMG_SIZE[0]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_flow_pool"] = None  # thread pool can not be pickled
+        state["_flow_pool_pid"] = None
+        return state
+
+    @property
+    def flow_pool(self):
+        # threads do not survive fork, each MultiprocessIterator worker creates its own pool
+        if self._flow_pool is None or self._flow_pool_pid != os.getpid():
+            self._flow_pool = ThreadPoolExecutor(max_workers=self.flow_fetch_threads)
+            self._flow_pool_pid = os.getpid()
+        return self._flow_pool
 
     def __len__(self):
         return self._num_examples
 
+    def memmap_path(self, memmap_dir, kind, ext="u8"):
+        return memmap_dir + os.path.sep + "{0}_{1}_fold_{2}_{3}.{4}".format(self.database, self.fold,
+                                                                            self.id_list_name, kind, ext)
+
+    @staticmethod
+    def read_resized_image(img_path):
+        return np.transpose(cv2.resize(cv2.imread(img_path), config.IMG_SIZE), (2, 0, 1))  # C, H, W
+
     def collect_flow_image_paths(self, data_index):
-        candidate = self.result_data[max(data_index - self.L//2,0) : min(data_index + self.L//2, len(self))]
-        seq_id = self.extract_sequence_key(self.result_data[data_index][0])
+        begin_index = max(data_index - self.L//2,0)
+        end_index = min(data_index + self.L//2, len(self))
+        same_seq_index = begin_index + np.nonzero(self.seq_ids[begin_index:end_index] == self.seq_ids[data_index])[0]
         collect_flow_path = []
-        for rgb_path, flow_path, _, _ in candidate:
-            other_seq_id = self.extract_sequence_key(rgb_path)
-            if other_seq_id == seq_id:
-                collect_flow_path.append({"flow": flow_path, "rgb": rgb_path})
+        for index in same_seq_index.tolist():
+            rgb_path, flow_path, _, _ = self.result_data[index]
+            collect_flow_path.append({"flow": flow_path, "rgb": rgb_path, "index": index})
         return collect_flow_path
 
     def extract_sequence_key(self, img_path):
@@ -78,25 +141,48 @@ class AUDataset(chainer.dataset.DatasetMixin):
             # use connectivity components to seperate polygon
             AU_inside_box_set = current_AU_couple[au_couple_tuple]
 
-            AU_bin = np.zeros(shape=len(config.AU_SQUEEZE), dtype=np.int32)  # 全0表示背景，脸上没有运动
-            for AU in AU_inside_box_set:  # AU_inside_box_set may has -3 or ?3
-                if AU not in config.AU_SQUEEZE.inv:
-                    continue
-                AU_squeeze = config.AU_SQUEEZE.inv[AU]  # AU_squeeze type = int
-                np.put(AU_bin, AU_squeeze, 1)
+            AU_bin = np.zeros(shape=len(config.AU_SQUEEZE), dtype=np.uint8)  # 全0表示背景，脸上没有运动, 0/1 only so uint8
+            # AU_inside_box_set may has -3 or ?3, which are not in AU_squeeze_idx
+            AU_bin[np.fromiter((self.AU_squeeze_idx[AU] for AU in AU_inside_box_set if AU in self.AU_squeeze_idx),
+                               dtype=np.int32)] = 1
             AU_couple_bin[au_couple_tuple] = AU_bin  # for the child
         # 循环两遍，第二遍拿出child_AU_couple
         for au_couple_tuple, box_list in couple_box_dict.items():
-            AU_child_bin = np.zeros(shape=len(config.AU_SQUEEZE), dtype=np.int32)
-            if au_couple_tuple in self.au_couple_child_dict:
-                for au_couple_child in self.au_couple_child_dict[au_couple_tuple]:
-                    AU_child_bin = np.bitwise_or(AU_child_bin, AU_couple_bin[au_couple_child])
-            AU_bin_tmp = AU_couple_bin[au_couple_tuple]  # 全0表示背景，脸上没有运动
-            AU_bin = np.bitwise_or(AU_child_bin, AU_bin_tmp)
+            AU_bin = np.bitwise_or.reduce([AU_couple_bin[au_couple_tuple]] +
+                                          [AU_couple_bin[au_couple_child] for au_couple_child in
+                                           self.au_couple_child_dict.get(au_couple_tuple, ())])
             bbox.extend(box_list)
             for _ in box_list:
                 label.append(AU_bin)
 
+    def get_cropface_and_box(self, orig_img_path, rgb_img_path, key_prefix):
+        # orig_img_path is unique (rgb image or its optical flow image), the crop rect comes from rgb_img_path
+        key = key_prefix + orig_img_path
+        if self.lmdb_manager is not None:
+            result = self.lmdb_manager.get(key)
+            if result is not None:
+                return result
+        new_face, AU_box_dict = FaceMaskCropper.get_cropface_and_box(orig_img_path, rgb_img_path,
+                                                                     channel_first=True,
+                                                                     mc_manager=self.mc_manager,
+                                                                     key_prefix=key_prefix)
+        if self.lmdb_manager is not None:
+            self.lmdb_manager.set(key, new_face, AU_box_dict)
+        return new_face, AU_box_dict
+
+    def get_flow_face(self, flow_dict, key_prefix):
+        adjacent_rgb_path = flow_dict["rgb"]
+        adjacent_flow_path = flow_dict["flow"]
+        try:
+            # FIXME read too slow, use the same rgb path to accelerate speed . but this trick is not accurate
+            flow_face, _ = self.get_cropface_and_box(adjacent_flow_path, adjacent_rgb_path, key_prefix)
+            return flow_face[:2, :, :]  # only use two channel x and y of optical flow image
+        except IndexError:
+            print("image path : {} not get box".format(adjacent_rgb_path))
+            if self.flow_memmap is not None:
+                return self.flow_memmap[flow_dict["index"]]
+            return self.read_resized_image(adjacent_flow_path)[:2, :, :]
+
     def get_npz_name(self, out_dir, database, fold, split_idx, sequence_key):
         sequence_key = sequence_key.replace("/","_")
         if self.split_name != "test":
@@ -132,47 +218,36 @@ class AUDataset(chainer.dataset.DatasetMixin):
         if self.pretrained_target is not None and len(self.pretrained_target) > 0:
             key_prefix = self.pretrained_target + "|"
 
-        flow_face_list = []
-        for flow_dict in flow_path_list:
-            adjacent_rgb_path = flow_dict["rgb"]
-            adjacent_flow_path = flow_dict["flow"]
-            try:
-                # FIXME read too slow, use the same rgb path to accelerate speed . but this trick is not accurate
-                flow_face, _ = FaceMaskCropper.get_cropface_and_box(adjacent_flow_path, adjacent_rgb_path,
-                                                                    channel_first=True,
-                                                                    mc_manager=self.mc_manager,
-                                                                    key_prefix=key_prefix)
-                flow_face = flow_face[:2, :, :]  # 2, H, W
-                flow_face_list.append(flow_face)  # only use two channel x and y of optical flow image
-            except IndexError:
-                print("image path : {} not get box".format(adjacent_rgb_path))
-                flow_face = cv2.imread(adjacent_flow_path)
-                flow_face = cv2.resize(flow_face, config.IMG_SIZE)
-                flow_face = np.transpose(flow_face, axes=(2, 0, 1))
-                flow_face = flow_face[:2, :, :]
-                flow_face_list.append(flow_face)
-
-        flow_face_list = np.stack(flow_face_list)  # T, C, H, W
-        if len(flow_face_list) < self.L:
-            rest_pad_len = self.L - len(flow_face_list)
-            flow_face_list = np.pad(flow_face_list, ((0, rest_pad_len), (0, 0), (0, 0), (0, 0)), 'mean')
+        # write every frame into its slot of the T, C, H, W output instead of np.stack + np.pad copies
+        flow_face_list = np.empty((self.L, 2, config.IMG_SIZE[1], config.IMG_SIZE[0]), dtype=np.uint8)
+        get_flow_face = functools.partial(self.get_flow_face, key_prefix=key_prefix)
+        if self.flow_fetch_threads > 1:
+            flow_faces = self.flow_pool.map(get_flow_face, flow_path_list)
+        else:
+            flow_faces = map(get_flow_face, flow_path_list)
+        for t, flow_face in enumerate(flow_faces):
+            flow_face_list[t] = flow_face
+
+        flow_len = len(flow_path_list)
+        if flow_len < self.L:
+            # same as np.pad(..., 'mean') along T: rest frames are the rounded mean of the fetched frames
+            flow_face_list[flow_len:] = np.around(flow_face_list[:flow_len].mean(axis=0))
         assert flow_face_list.shape[0] == self.L
 
         try:
             # print("begin fetch cropped image and bbox {}".format(img_path))
-            rgb_face, AU_box_dict = FaceMaskCropper.get_cropface_and_box(rgb_path, rgb_path,
-                                                                         channel_first=True,
-                                                                         mc_manager=self.mc_manager,
-                                                                         key_prefix=key_prefix)
+            rgb_face, AU_box_dict = self.get_cropface_and_box(rgb_path, rgb_path, key_prefix)
         except IndexError:
             print("image path : {} not get box".format(rgb_path))
             label = np.zeros(len(config.AU_SQUEEZE), dtype=np.int32)
-            for AU in AU_set:
-                np.put(label, config.AU_SQUEEZE.inv[AU], 1)
+            label[np.fromiter((self.AU_squeeze_idx[AU] for AU in AU_set), dtype=np.int32)] = 1
             if self.paper_report_label_idx:
                 label = label[self.paper_report_label_idx]
 
-            rgb_face = np.transpose(cv2.resize(cv2.imread(rgb_path), config.IMG_SIZE), (2, 0, 1))
+            if self.rgb_memmap is not None:
+                rgb_face = np.array(self.rgb_memmap[i])
+            else:
+                rgb_face = self.read_resized_image(rgb_path)
 
             whole_bbox = np.tile(np.array([1, 1, config.IMG_SIZE[1] - 1, config.IMG_SIZE[0] - 1], dtype=np.float32),
                                  (config.BOX_NUM[database], 1))
@@ -192,7 +267,7 @@ class AUDataset(chainer.dataset.DatasetMixin):
             except KeyError:
                 print(list(self.au_couple_dict.keys()), AU)
                 raise
-        for AU, box_list in sorted(AU_box_dict.items(), key=lambda e: int(e[0])):
+        for AU, box_list in AU_box_dict.items():  # FaceMaskCropper inserts AU in int order
             assert AU.isdigit()
             if AU in config.SYMMETRIC_AU and len(box_list) == 1:
                 box_list.append(random.choice(box_list))
@@ -203,7 +278,7 @@ class AUDataset(chainer.dataset.DatasetMixin):
         # print("assigned label over")
         assert len(bbox) > 0
         bbox = np.stack(bbox).astype(np.float32)
-        label = np.stack(label).astype(np.int32)
+        label = np.stack(label).astype(np.int32)  # uint8 bits -> int32 only at the return boundary
         # bbox, label = self.proposal(bbox, label)  # 必须保证每个batch拿到的box数量一样
         assert bbox.shape[0] == label.shape[0]
         if self.paper_report_label_idx is not None:
@@ -17,7 +17,7 @@ class DumpRoIFeature(Evaluator):
     priority = chainer.training.PRIORITY_WRITER
 
     def __init__(self, iterator, model, device, database, converter,
-                 output_path, trainval_test, fold_split_idx, mirror_data=False):
+                 output_path, trainval_test, fold_split_idx, mirror_data=False, mean_rgb=None, mean_flow=None):
 
         super(DumpRoIFeature, self).__init__(iterator, model, device=device, converter=converter)
         self.database = database
@@ -26,6 +26,20 @@ class DumpRoIFeature(Evaluator):
         self.trainval_test = trainval_test
         self.fold_split_idx = fold_split_idx
         self.mirror_data = mirror_data
+        # faces come from the dataset as uint8, the mean (C, H, W) / (T, C, H, W) is subtracted after upload.
+        # mirrored faces are flipped before the mean subtraction, so the mean is flipped the same way here
+        if mirror_data:
+            mean_rgb = None if mean_rgb is None else mean_rgb[..., ::-1]
+            mean_flow = None if mean_flow is None else mean_flow[..., ::-1]
+        self.mean_rgb = None if mean_rgb is None else np.ascontiguousarray(mean_rgb, dtype=np.float32)
+        self.mean_flow = None if mean_flow is None else np.ascontiguousarray(mean_flow, dtype=np.float32)
+
+    def to_device_float(self, img, mean):
+        # uint8 travels to the device, cast and mean subtraction happen there
+        img = chainer.cuda.to_gpu(img, self.device).astype('f')
+        if mean is not None:
+            img -= mean
+        return img
 
     def get_npz_name(self, AU_group_id, trainval_test, out_dir, database, fold, split_idx, sequence_key):
 
@@ -101,6 +115,8 @@ class DumpRoIFeature(Evaluator):
 
         model = _target
         last_sequence_key = None
+        mean_rgb = None if self.mean_rgb is None else chainer.cuda.to_gpu(self.mean_rgb, self.device)
+        mean_flow = None if self.mean_flow is None else chainer.cuda.to_gpu(self.mean_flow, self.device)
 
         rgb_roi_feature_list = []
         flow_roi_feature_list = []
@@ -136,8 +152,8 @@ class DumpRoIFeature(Evaluator):
                 last_sequence_key = sequence_key
 
             if not isinstance(rgb_faces, chainer.Variable):
-                rgb_faces = chainer.Variable(chainer.cuda.to_gpu(rgb_faces.astype('f'), self.device))
-                flow_faces = chainer.Variable(chainer.cuda.to_gpu(flow_faces.astype('f'), self.device))
+                rgb_faces = chainer.Variable(self.to_device_float(rgb_faces, mean_rgb))
+                flow_faces = chainer.Variable(self.to_device_float(flow_faces, mean_flow))
                 bboxes = chainer.Variable(chainer.cuda.to_gpu(bboxes.astype('f'), self.device))
 
             if sequence_key != last_sequence_key:  # 换video了
@@ -27,23 +27,51 @@ class ProposalTargetCreator(object):
             if IoU is in
             [:obj:`neg_iou_thresh_hi`, :obj:`neg_iou_thresh_hi`).
         neg_iou_thresh_lo (float): See above.
+        loc_normalize_mean (tuple of 2 floats): Default mean values to
+            normalize coordinates of bouding segments.
+        loc_normalize_std (tuple of 2 floats): Default standard deviation of
+            the coordinates of bounding segments.
+        seed (int): Seed of the random generator used to sample RoIs,
+            ``None`` seeds it from the OS entropy.
 
     """
 
     def __init__(self,
                  n_sample=128,
                  pos_ratio=0.25, pos_iou_thresh=0.5,
-                 neg_iou_thresh_hi=0.5, neg_iou_thresh_lo=0.0
+                 neg_iou_thresh_hi=0.5, neg_iou_thresh_lo=0.0,
+                 loc_normalize_mean=(0., 0.), loc_normalize_std=(0.1, 0.2),
+                 seed=None
                  ):
         self.n_sample = n_sample
         self.pos_ratio = pos_ratio
         self.pos_iou_thresh = pos_iou_thresh
         self.neg_iou_thresh_hi = neg_iou_thresh_hi
         self.neg_iou_thresh_lo = neg_iou_thresh_lo
+        self.loc_normalize_mean = loc_normalize_mean
+        self.loc_normalize_std = loc_normalize_std
+        self._loc_normalize_cache = dict()  # (is numpy, mean, std) -> float32 arrays on that array module
+        self.seed = seed
+        self._random_states = dict()  # is numpy -> RandomState of that array module
+
+    def _random_state(self, xp):
+        # one generator per creator and array module, created once instead of going through the global one
+        key = xp is np
+        if key not in self._random_states:
+            self._random_states[key] = xp.random.RandomState(self.seed)
+        return self._random_states[key]
+
+    def _loc_normalize_arrays(self, xp, loc_normalize_mean, loc_normalize_std):
+        # converted (and sent to GPU) once per value instead of on every call
+        key = (xp is np, tuple(loc_normalize_mean), tuple(loc_normalize_std))
+        if key not in self._loc_normalize_cache:
+            self._loc_normalize_cache[key] = (xp.asarray(loc_normalize_mean, dtype=xp.float32),
+                                              xp.asarray(loc_normalize_std, dtype=xp.float32))
+        return self._loc_normalize_cache[key]
 
     def __call__(self, rois, roi_indices, gt_segments, labels, batch_seg_info,
-                 loc_normalize_mean=(0., 0.),
-                 loc_normalize_std=(0.1,  0.2)):
+                 loc_normalize_mean=None,
+                 loc_normalize_std=None):
         """Assigns ground truth to sampled proposals.
 
         This function samples total of :obj:`self.n_sample` RoIs
@@ -74,9 +102,11 @@ class ProposalTargetCreator(object):
                 is :math:` (B, R')`.
             batch_seg_info (np.array) its shape is `(B, 2)`, which indicate AU group index, segment count of each batch index
             loc_normalize_mean (tuple of 2 floats): Mean values to normalize
-                coordinates of bouding segments.
+                coordinates of bouding segments. ``None`` uses the value
+                given in :meth:`__init__`.
             loc_normalize_std (tupler of 2 floats): Standard deviation of
-                the coordinates of bounding boxes.
+                the coordinates of bounding boxes. ``None`` uses the value
+                given in :meth:`__init__`.
 
         Returns:
             (array, array, array):
@@ -91,78 +121,92 @@ class ProposalTargetCreator(object):
                 value 0 is the background.
 
         """
+        # everything below runs on the array module of the inputs, so nothing is moved between host and device
         xp = cuda.get_array_module(rois)
-        rois = cuda.to_cpu(rois)
-        roi_indices = cuda.to_cpu(roi_indices)
-        gt_segments = cuda.to_cpu(gt_segments)
-        labels = cuda.to_cpu(labels) # shape = (B, R')
-        batch_seg_info = cuda.to_cpu(batch_seg_info)
+        roi_indices = xp.asarray(roi_indices)
+        gt_segments = xp.asarray(gt_segments)
+        labels = xp.asarray(labels) # shape = (B, R')
+        batch_seg_info = xp.asarray(batch_seg_info)
         assert batch_seg_info.ndim == 2
         mini_batch = gt_segments.shape[0]
         assert mini_batch == labels.shape[0]
-        batch_rois =[]
-        batch_rois_indices = []
-        batch_labels = []
-        batch_roi_locs = []
-        for b_id in range(mini_batch):
-            _, seg_number = batch_seg_info[b_id]
-            gt_seg = gt_segments[b_id][:int(seg_number)]
-            roi_inds = np.where(roi_indices == b_id)
-
-            all_rois = rois[roi_inds]
-            label = labels[b_id][:int(seg_number)]  # shape = R,
-
-            n_bbox, _ = gt_seg.shape
-            all_rois = np.concatenate((all_rois, gt_seg), axis=0)  # (R + R', 2), 和gt box的混合列表
-            roi_indice_this_timeline = np.ones(all_rois.shape[0], dtype=np.int32) * b_id
-            pos_roi_per_timeline = np.round(self.n_sample * self.pos_ratio)  # 按照一定比例生成正例
-            iou = segments_iou(all_rois, gt_seg) # 返回一个n x k的矩阵（表格）。表示n个rois与k个bbox的IOU
-            gt_assignment = iou.argmax(axis=1) # shape = n, 挑出每一行中哪个列最大的index，gt_assigment的shape与roi的行数相同，但gt_assigment的值范围再bbox的R'内
-            max_iou = iou.max(axis=1) # shape = n, 挑出每一行中哪个列最大，也就是哪个gt的bbox与该roi_bbox混合列表的元素最接近
-            gt_roi_label = label[gt_assignment] + 1  # shape = (n, 12) 因为label的index是跟bbox是一致的，而与roi不一致，因此上面gt_assignment = iou.argmax(axis=1)
-            # Select foreground RoIs as those with >= pos_iou_thresh IoU. IoU刷掉了一批不合适的ROI，从roi_bbox混合列表去选
-            pos_index = np.where(max_iou >= self.pos_iou_thresh)[0]
-            pos_roi_this_timeline = int(min(pos_roi_per_timeline, pos_index.size))  # 取1:3的pos个数和实际pos_index个数的较小者
-            if pos_index.size > 0:
-                pos_index = np.random.choice(
-                    pos_index, size=pos_roi_this_timeline, replace=False)  # 随机采样
-
-            # Select background RoIs as those within
-            # [neg_iou_thresh_lo, neg_iou_thresh_hi). 比较小的一定阈值之内的IoU视为负的label
-            neg_index = np.where((max_iou < self.neg_iou_thresh_hi) &
-                                 (max_iou >= self.neg_iou_thresh_lo))[0]
-            neg_roi_per_this_timeline = self.n_sample - pos_roi_this_timeline
-            neg_roi_per_this_timeline = int(min(neg_roi_per_this_timeline,
-                                             neg_index.size))
-            if neg_index.size > 0:
-                neg_index = np.random.choice(
-                    neg_index, size=neg_roi_per_this_timeline, replace=False)
-
-            # The indices that we're selecting (both positive and negative).
-            keep_index = np.append(pos_index, neg_index)
-            gt_roi_label = gt_roi_label[keep_index]
-            # 下面改成multi label的向量
-            gt_roi_label[pos_roi_this_timeline:] = 0  # 因为是concat起来，所以正例数量一过，可以强行设置为负的label。negative labels --> 0
-            sample_roi = all_rois[keep_index]
-            sample_roi_indices = roi_indice_this_timeline[keep_index]
-
-            # Compute offsets and scales to match sampled RoIs to the GTs.
-            gt_roi_loc = encode_segment_target(sample_roi, gt_seg[gt_assignment[keep_index]])  # shape = N, 2
-            assert gt_roi_loc.shape[1] == 2, gt_roi_loc.shape
-            gt_roi_loc = ((gt_roi_loc - np.array(loc_normalize_mean, np.float32)
-                           ) / np.array(loc_normalize_std, np.float32))
-
-            if xp != np:
-                sample_roi = cuda.to_gpu(sample_roi)  # S,2
-                gt_roi_loc = cuda.to_gpu(gt_roi_loc)  # S,2
-                sample_roi_indices = cuda.to_gpu(sample_roi_indices) # S,
-                gt_roi_label = cuda.to_gpu(gt_roi_label)  # S
-                assert sample_roi.shape[0] == gt_roi_loc.shape[0] == sample_roi_indices.shape[0] == gt_roi_label.shape[0]
-            batch_rois.append(sample_roi)
-            batch_rois_indices.append(sample_roi_indices)
-            batch_labels.append(gt_roi_label)
-            batch_roi_locs.append(gt_roi_loc)
-            # TODO _get_bbox_regression_labels???
+        # all timelines are processed in one pass, the batch index of every row is carried along instead of looping
+        seg_number = batch_seg_info[:, 1].astype(xp.int32)  # shape = (B,)
+        gt_mask = xp.arange(gt_segments.shape[1])[None, :] < seg_number[:, None]  # shape = (B, R'), drop padding
+        gt_seg = gt_segments[gt_mask]  # shape = (K, 2), K is gt segment count across all batch index
+        gt_label = labels[gt_mask]  # shape = (K,)
+        gt_batch = xp.nonzero(gt_mask)[0]  # shape = (K,)
+
+        all_rois = xp.concatenate((rois, gt_seg), axis=0)  # (R + K, 2), 和gt box的混合列表
+        all_batch = xp.concatenate((roi_indices, gt_batch)).astype(xp.int32)  # (R + K,)
+        pos_roi_per_timeline = int(round(self.n_sample * self.pos_ratio))  # 按照一定比例生成正例
+        random_state = self._random_state(xp)
+        iou = segments_iou(all_rois, gt_seg) # 返回一个n x k的矩阵（表格）。表示n个rois与k个bbox的IOU
+        # block diagonal: a RoI is only matched against the gt segments of its own timeline,
+        # IoU is never negative so -1 never wins the argmax / max below
+        iou[all_batch[:, None] != gt_batch[None, :]] = -1
+        gt_assignment = iou.argmax(axis=1) # shape = n, 挑出每一行中哪个列最大的index
+        max_iou = iou.max(axis=1) # shape = n, 挑出每一行中哪个列最大，也就是哪个gt的bbox与该roi_bbox混合列表的元素最接近
+
+        # Select foreground RoIs as those with >= pos_iou_thresh IoU. IoU刷掉了一批不合适的ROI，从roi_bbox混合列表去选
+        pos_index, pos_batch, pos_rank, pos_count = _shuffle_within_batch(
+            xp.where(max_iou >= self.pos_iou_thresh)[0], all_batch, mini_batch, random_state)
+        pos_roi_this_timeline = xp.minimum(pos_roi_per_timeline, pos_count)  # 取1:3的pos个数和实际pos_index个数的较小者
+        pos_keep = pos_rank < pos_roi_this_timeline[pos_batch]  # 随机采样
+
+        # Select background RoIs as those within
+        # [neg_iou_thresh_lo, neg_iou_thresh_hi). 比较小的一定阈值之内的IoU视为负的label
+        neg_index, neg_batch, neg_rank, neg_count = _shuffle_within_batch(
+            xp.where((max_iou < self.neg_iou_thresh_hi) & (max_iou >= self.neg_iou_thresh_lo))[0],
+            all_batch, mini_batch, random_state)
+        neg_roi_per_this_timeline = xp.minimum(self.n_sample - pos_roi_this_timeline, neg_count)
+        neg_keep = neg_rank < neg_roi_per_this_timeline[neg_batch]
+
+        # The indices that we're selecting (both positive and negative), grouped by batch index, positive first.
+        pos_index, pos_batch = pos_index[pos_keep], pos_batch[pos_keep]
+        neg_index, neg_batch = neg_index[neg_keep], neg_batch[neg_keep]
+        keep_index = xp.concatenate((pos_index, neg_index))
+        keep_batch = xp.concatenate((pos_batch, neg_batch))
+        is_neg = xp.concatenate((xp.zeros(pos_index.size, dtype=bool), xp.ones(neg_index.size, dtype=bool)))
+        order = xp.lexsort(xp.stack((is_neg.astype(xp.int32), keep_batch)))
+        keep_index, keep_batch, is_neg = keep_index[order], keep_batch[order], is_neg[order]
+
+        gt_roi_label = gt_label[gt_assignment[keep_index]] + 1  # 因为label的index是跟bbox是一致的，而与roi不一致
+        gt_roi_label[is_neg] = 0  # negative labels --> 0
+        sample_roi = all_rois[keep_index]
+        sample_roi_indices = keep_batch.astype(xp.int32)
+
+        # Compute offsets and scales to match sampled RoIs to the GTs.
+        gt_roi_loc = encode_segment_target(sample_roi, gt_seg[gt_assignment[keep_index]])  # shape = N, 2
+        assert gt_roi_loc.shape[1] == 2, gt_roi_loc.shape
+        loc_mean, loc_std = self._loc_normalize_arrays(
+            xp, self.loc_normalize_mean if loc_normalize_mean is None else loc_normalize_mean,
+            self.loc_normalize_std if loc_normalize_std is None else loc_normalize_std)
+        gt_roi_loc -= loc_mean  # in place, gt_roi_loc is a fresh array
+        gt_roi_loc /= loc_std
+        # TODO _get_bbox_regression_labels???
+
+        assert sample_roi.shape[0] == gt_roi_loc.shape[0] == sample_roi_indices.shape[0] == gt_roi_label.shape[0]
         # return (B*S, 2)  (B*S,),  (B*S, 2),  (B*S, )
-        return xp.concatenate(batch_rois, axis=0), xp.concatenate(batch_rois_indices, axis=0), \
-               xp.concatenate(batch_roi_locs,axis=0), xp.concatenate(batch_labels, axis=0)
+        return sample_roi, sample_roi_indices, gt_roi_loc, gt_roi_label
+
+
+def _shuffle_within_batch(index, batch, mini_batch, random_state):
+    """Randomly order :obj:`index` inside each batch index.
+
+    Returns the shuffled indices grouped by batch index, their batch index,
+    their rank inside their own batch index and the count of each batch index.
+    Taking ``rank < k`` keeps :obj:`k` random indices of every batch index
+    without replacement, which is what ``np.random.choice`` did per batch.
+
+    """
+    xp = cuda.get_array_module(index)
+    index_batch = batch[index]
+    if index.size == 0:  # no RoI of the whole batch falls in the IoU range, cupy.bincount fails on an empty array
+        return index, index_batch, index, xp.zeros(mini_batch, dtype=xp.int64)
+    order = xp.lexsort(xp.stack((random_state.random_sample(index.size), index_batch)))  # sort by batch, random inside one batch
+    index, index_batch = index[order], index_batch[order]
+    count = xp.bincount(index_batch, minlength=mini_batch)
+    start = xp.cumsum(count) - count
+    rank = xp.arange(index.size) - start[index_batch]
+    return index, index_batch, rank, count
@@ -111,28 +111,37 @@ def encode_segment_target(src_seg, dst_seg):
     ctr_x = src_seg[:, 0] + 0.5 * width  # shape = R
 
     base_width = dst_seg[:, 1] - dst_seg[:, 0]
-    base_ctr_x = dst_seg[:, 0] + 0.5 * base_width
 
-    dx = (base_ctr_x - ctr_x) / width  # shape =R
-    dw = xp.log(base_width / width)  # shape =R
-
-    loc = xp.vstack((dx, dw)).transpose()  # shape = R, 2; each row is (dx[i], dw[i])
+    # both columns are written in place into the output, no vstack + transpose copy
+    loc = xp.empty((width.shape[0], 2), dtype=xp.result_type(ctr_x, base_width))  # shape = R, 2; (dx[i], dw[i])
+    dx = loc[:, 0]
+    xp.multiply(base_width, 0.5, out=dx)
+    dx += dst_seg[:, 0]  # base_ctr_x
+    dx -= ctr_x
+    dx /= width
+    dw = loc[:, 1]
+    xp.divide(base_width, width, out=dw)
+    xp.log(dw, out=dw)
     return loc
 
 
 def segments_iou(seg_a, seg_b):
-    if seg_a.shape[1] != 2 or seg_a.shape[1] != 2:
+    if seg_a.shape[1] != 2 or seg_b.shape[1] != 2:
         raise IndexError
     xp = cuda.get_array_module(seg_a)
-    xa_min, xa_max = xp.split(seg_a, 2, axis=1)  # xa_min = (N,)
-    xb_min, xb_max = xp.split(seg_b, 2, axis=1)
-    xA = xp.maximum(xa_min, xp.transpose(xb_min))
-    xB = xp.minimum(xa_max, xp.transpose(xb_max))
-    interArea = xp.maximum((xB - xA + 1), 0)
-    segAArea = (xa_max - xa_min + 1)
-    segBArea = (xb_max - xb_min + 1)
-    iou = interArea / (segAArea + xp.transpose(segBArea) - interArea)
-    return iou
+    # column views, no copy: a -> (N, 1), b -> (K,), broadcast to (N, K) only where needed
+    xa_min, xa_max = seg_a[:, 0, None], seg_a[:, 1, None]
+    xb_min, xb_max = seg_b[:, 0], seg_b[:, 1]
+    inter = xp.minimum(xa_max, xb_max)  # (N, K), the only buffers of this size are inter and union
+    inter -= xp.maximum(xa_min, xb_min)
+    inter += 1
+    xp.maximum(inter, 0, out=inter)
+    union = (xa_max - xa_min + 1) + (xb_max - xb_min + 1)  # (N, 1) + (K,) -> (N, K)
+    union -= inter
+    if inter.dtype.kind != 'f':
+        return inter / union
+    inter /= union
+    return inter  # iou
 
 
 
@@ -173,7 +182,8 @@ def bbox_iou(bbox_a, bbox_b):
     # bottom right
     br = xp.minimum(bbox_a[:, None, 2:], bbox_b[:, 2:])
 
-    area_i = xp.prod(br - tl, axis=2) * (tl < br).all(axis=2)
+    # clamp the negative extent to 0 instead of building a (tl < br) mask, same result without the bool temporaries
+    area_i = xp.prod(xp.maximum(br - tl, 0), axis=2)
     area_a = xp.prod(bbox_a[:, 2:] - bbox_a[:, :2], axis=1)
     area_b = xp.prod(bbox_b[:, 2:] - bbox_b[:, :2], axis=1)
     return area_i / (area_a[:, None] + area_b - area_i)
@@ -0,0 +1,45 @@
+import argparse
+import os
+
+import numpy as np
+
+import config
+from dataset_toolkit.adaptive_AU_config import adaptive_AU_database
+from time_axis_rcnn.datasets.AU_dataset import AUDataset
+
+
+# decode and resize every rgb/flow image of one split once, AUDataset(memmap_dir=...) reads them back
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default="BP4D")
+    parser.add_argument("--fold", '-fd', type=int, default=3)
+    parser.add_argument("--split_name", default="trainval", help="trainval or test")
+    parser.add_argument("--split_idx", '-sp', type=int, default=1)
+    parser.add_argument("--train_all_data", action="store_true", help="use full_pretrain.txt id file")
+    parser.add_argument("--out_dir", '-o', default="/home/machen/dataset/face_memmap/")
+    args = parser.parse_args()
+    adaptive_AU_database(args.database)
+    dataset = AUDataset(database=args.database, L=1, fold=args.fold, split_name=args.split_name,
+                        split_index=args.split_idx, mc_manager=None, train_all_data=args.train_all_data)
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    N = len(dataset)
+    H, W = config.IMG_SIZE[1], config.IMG_SIZE[0]
+    rgb_memmap = np.memmap(dataset.memmap_path(args.out_dir, "rgb"), dtype=np.uint8, mode='w+', shape=(N, 3, H, W))
+    flow_memmap = np.memmap(dataset.memmap_path(args.out_dir, "flow"), dtype=np.uint8, mode='w+', shape=(N, 2, H, W))
+    for i, (rgb_path, flow_path, _, _) in enumerate(dataset.result_data):
+        rgb_memmap[i] = dataset.read_resized_image(rgb_path)
+        if os.path.exists(flow_path):
+            flow_memmap[i] = dataset.read_resized_image(flow_path)[:2, :, :]
+        if (i + 1) % 1000 == 0:
+            print("processed {0}/{1} images".format(i + 1, N))
+    rgb_memmap.flush()
+    flow_memmap.flush()
+    # row i of the memmaps is image i of this list, AUDataset checks it before using the memmaps
+    with open(dataset.memmap_path(args.out_dir, "paths", "txt"), "w") as file_obj:
+        file_obj.write("\n".join(entry[0] for entry in dataset.result_data) + "\n")
+    print("write done: {}".format(dataset.memmap_path(args.out_dir, "*", "*")))
+
+
+if __name__ == "__main__":
+    main()
@@ -34,20 +34,15 @@ import numpy as np
 
 class Transform(object):
 
-    def __init__(self, L, mean_rgb_path, mean_flow_path, mirror=True):
+    # faces stay uint8 here, DumpRoIFeature subtracts the mean on GPU after the upload
+    def __init__(self, mirror=True):
         self.mirror = mirror
-        self.mean_rgb = np.load(mean_rgb_path)
-        self.mean_rgb = self.mean_rgb.astype(np.float32)
-        self.mean_flow = np.tile(np.expand_dims(np.load(mean_flow_path),  axis=0), reps=(L, 1, 1, 1))[:, :2, :, :]
-        self.mean_flow = self.mean_flow.astype(np.float32)
 
     def __call__(self, in_data):
         rgb_img, flow_img_list, bbox, label, rgb_path = in_data  # flow_img_list shape = (T, C, H, W), and bbox = (F,4)
         if rgb_img is None:
             return None, None, None, None, rgb_path
-        rgb_img = rgb_img - self.mean_rgb
-        assert flow_img_list.shape == self.mean_flow.shape
-        flow_imgs = flow_img_list - self.mean_flow
+        flow_imgs = flow_img_list
 
         assert len(np.where(bbox < 0)[0]) == 0
         # horizontally flip and random shift box
@@ -111,6 +106,10 @@ def main():
                         help='whether use memcached to boost speed of fetch crop&mask')
     parser.add_argument('--proc_num', type=int, default=10)
     parser.add_argument('--memcached_host', default='127.0.0.1')
+    parser.add_argument('--lmdb_cache', default='', help='lmdb directory to cache cropped face and AU box, empty to disable')
+    parser.add_argument('--flow_fetch_threads', type=int, default=1,
+                        help='threads to fetch the T flow crops of one example, only without memcached')
+    parser.add_argument('--memmap_dir', default='', help='directory written by build_face_memmap.py, empty to disable')
     parser.add_argument('--mean_rgb', default=config.ROOT_PATH + "BP4D/idx/mean_rgb.npy", help='image mean .npy file')
     parser.add_argument('--mean_flow', default=config.ROOT_PATH + "BP4D/idx/mean_flow.npy", help='image mean .npy file')
 
@@ -122,6 +121,10 @@ def main():
         mc_manager = PyLibmcManager(args.memcached_host)
         if mc_manager is None:
             raise IOError("no memcached found listen in {}".format(args.memcached_host))
+    lmdb_manager = None
+    if args.lmdb_cache:
+        from collections_toolkit.lmdb_manager import LMDBCropFaceManager
+        lmdb_manager = LMDBCropFaceManager(args.lmdb_cache)
 
     return_dict = extract_mode(args.model)
     database = return_dict["database"]
@@ -173,13 +176,17 @@ def main():
                             fold=fold, split_name=args.trainval_test,
                             split_index=split_idx, mc_manager=mc_manager,
                             train_all_data=False,
-                            paper_report_label_idx=paper_report_label_idx, jump_exists=True, npz_dir=args.out_dir)
+                            paper_report_label_idx=paper_report_label_idx, jump_exists=True, npz_dir=args.out_dir,
+                            lmdb_manager=lmdb_manager, memmap_dir=args.memmap_dir,
+                            flow_fetch_threads=args.flow_fetch_threads)
+    mean_rgb = np.load(args.mean_rgb).astype(np.float32)
+    mean_flow = np.tile(np.expand_dims(np.load(args.mean_flow), axis=0), reps=(T, 1, 1, 1))[:, :2, :, :]
+    mean_flow = mean_flow.astype(np.float32)
     mirror_list = [False,]
     if args.mirror and args.trainval_test == 'trainval':
         mirror_list.append(True)
     for mirror in mirror_list:
-        train_dataset = TransformDataset(img_dataset, Transform(T, mean_rgb_path=args.mean_rgb,
-                                                                mean_flow_path=args.mean_flow, mirror=mirror))
+        train_dataset = TransformDataset(img_dataset, Transform(mirror=mirror))
 
 
         if args.proc_num > 1:
@@ -195,7 +202,8 @@ def main():
             'train', False):
             model_dump = DumpRoIFeature(dataset_iter, model, args.gpu, database,
                                         converter=lambda batch, device: concat_examples_not_string(batch, device, padding=0),
-                                        output_path=args.out_dir, trainval_test=args.trainval_test, fold_split_idx=split_idx, mirror_data=mirror)
+                                        output_path=args.out_dir, trainval_test=args.trainval_test, fold_split_idx=split_idx, mirror_data=mirror,
+                                        mean_rgb=mean_rgb, mean_flow=mean_flow)
             model_dump.evaluate()
 
 if __name__ == "__main__":
@@ -194,28 +194,17 @@ class AUDataset(chainer.dataset.DatasetMixin):
 
         if bbox.shape[0] != config.BOX_NUM[database]:
             print("found one error image: {0} box_number:{1}".format(rgb_path, bbox.shape[0]))
-            bbox = bbox.tolist()
-            label = label.tolist()
-
-            if len(bbox) > config.BOX_NUM[database]:
-                all_del_idx = []
-                for idx, box in enumerate(bbox):
-                    if FaceMaskCropper.calculate_area(*box) / float(config.IMG_SIZE[0] * config.IMG_SIZE[1]) < 0.01:
-                        all_del_idx.append(idx)
-                for del_idx in all_del_idx:
-                    del bbox[del_idx]
-                    del label[del_idx]
-
-            while len(bbox) < config.BOX_NUM[database]:
-                index = 0
-                bbox.insert(0, bbox[index])
-                label.insert(0, label[index])
-            while len(bbox) > config.BOX_NUM[database]:
-                del bbox[-1]
-                del label[-1]
-
-            bbox = np.stack(bbox)
-            label = np.stack(label)
+            box_num = config.BOX_NUM[database]
+            if bbox.shape[0] > box_num:
+                # calculate_area works column-wise on the (R, 4) array, drop all small boxes at once
+                area_ratio = FaceMaskCropper.calculate_area(*bbox.T) / float(config.IMG_SIZE[0] * config.IMG_SIZE[1])
+                keep = area_ratio >= 0.01
+                bbox, label = bbox[keep], label[keep]
+            pad_num = box_num - bbox.shape[0]
+            if pad_num > 0:  # repeat the first box in front
+                bbox = np.concatenate((np.repeat(bbox[:1], pad_num, axis=0), bbox))
+                label = np.concatenate((np.repeat(label[:1], pad_num, axis=0), label))
+            bbox, label = bbox[:box_num], label[:box_num]
 
         if self.paper_report_label_idx is not None:
             label = label[:, self.paper_report_label_idx]